@@ -1,47 +1,119 @@
 #!/usr/bin/env python
 
 from mpi4py import MPI
+import numpy as np
+import zlib
+
+# pickle protocol 5 support requires mpi4py 3.1 or newer.  fall back to the
+# standard pickled collectives when it isn't available.
+try:
+    from mpi4py.util import pkl5
+except ImportError:
+    pkl5 = None
 
 def partition_by_string( intracomm, color_string ):
+    """
+    Partitions an intracommunicator into groups of ranks that provided the same
+    string.  This is useful for identifying the ranks of each application in
+    an MPMD launch.
+
+    Takes 2 arguments:
+
+      intracomm    - Intracommunicator to partition.
+      color_string - String identifying this rank's group.
+
+    Returns 1 value:
+
+      comm - Intracommunicator containing the ranks that provided the same
+             color_string, ordered by their rank in intracomm.
+
+    """
+
     # XXX: adapted from:
     #
     # https://stackoverflow.com/questions/35924226/openmpi-mpmd-get-communication-size
     #
-
-    # identify the longest color string so we can size our buffer properly.
+    # though rather than collecting every rank's string to find the first
+    # occurrence of ours we hash it into a color.  this avoids an allgather of
+    # pickled strings whose size grows with the number of ranks.
     #
-    # NOTE: since we're using a Pythonic approach to MPI we don't actually need
-    #       this value.  we'd use it to allocate a buffer of
-    #       intracomm_size * maximum_color_length to call MPI_Allgather() into.
-    #maximum_name_length = intracomm.allreduce( len( color_string ), max )
+    # NOTE: different strings could hash to the same color and be placed in the
+    #       same group.  this is unlikely for the handful of applications in a
+    #       single launch.
+    color = zlib.crc32( color_string.encode( "utf-8" ) ) & 0x7fffffff
+
+    return intracomm.Split( color, key=intracomm.Get_rank() )
+
+def make_intercomm( local_comm, local_leader, peer_comm, remote_leader ):
+    """
+    Creates an intercommunicator between the ranks of a local intracommunicator
+    and every other rank in a peer intracommunicator.  MPI-4's group-based
+    creation is used when available, which avoids communicating through the
+    peer intracommunicator.  Otherwise, this falls back to MPI_Intercomm_create().
+
+    Takes 4 arguments:
+
+      local_comm    - Intracommunicator containing the local group's ranks.
+      local_leader  - Rank of the local group's leader in local_comm.
+      peer_comm     - Intracommunicator containing both the local and remote
+                      groups' ranks, and no others.
+      remote_leader - Rank of the remote group's leader in peer_comm.
+
+    Returns 1 value:
+
+      intercomm - Intercommunicator between the local and remote groups.
+
+    """
+
+    local_group  = local_comm.Get_group()
+    peer_group   = peer_comm.Get_group()
+    remote_group = MPI.Group.Difference( peer_group, local_group )
 
-    # collect the names of every application in our universe.
-    colors = intracomm.allgather( color_string )
+    try:
+        # the remote leader must be identified by its rank in the remote group
+        # rather than in the peer intracommunicator.
+        remote_group_leader = MPI.Group.Translate_ranks( peer_group,
+                                                         [remote_leader],
+                                                         remote_group )[0]
 
-    # loop through concatenated names to find the first one that matches,
-    # track that index to split the groups by.
-    color_index = colors.index( color_string )
+        intercomm = MPI.Intercomm.Create_from_groups( local_group,
+                                                      local_leader,
+                                                      remote_group,
+                                                      remote_group_leader )
+    except (AttributeError, NotImplementedError):
+        # either mpi4py or the underlying MPI implementation predates
+        # group-based creation.
+        intercomm = local_comm.Create_intercomm( local_leader, peer_comm, remote_leader )
+    finally:
+        for group in (local_group, peer_group, remote_group):
+            group.Free()
 
-    return intracomm.Split( color_index, key=intracomm.Get_rank() )
+    return intercomm
 
-def intercomm_broadcast( intercomm, send_value, local_rank, local_root, sending_flag ):
+def intercomm_broadcast( intercomm, send_value, local_rank, local_root, sending_flag, buffer_flag=False ):
     """
     Wrapper for broadcasting a value over an intercommunicator.  Since
     broadcasting from one group to another via an intercommunicator is a
     superset of a broadcast across a single group via an intracommunicator,
     this function handles setting the broadcast root within each group.
 
-    Takes 5 arguments:
+    Takes 6 arguments:
 
       intercomm     - Intercommunicator used to broadcast data from one
                       group to another.
       send_value    - Broadcast value.  This is only used on the root
-                      rank.
+                      rank, unless buffer_flag is set.
       local_rank    - Rank in the local group.
       local_root    - Rank in the local, sending group who performs the
                       broadcast.
       sending_flag  - Flag indicating whether this rank is in the sending
                       or receiving group.
+      buffer_flag   - Optional flag indicating whether send_value is a NumPy
+                      array broadcast directly from its buffer rather than
+                      pickled.  When set, every rank must provide an array
+                      whose shape and type match the root's array.  The
+                      receiving group's array contents are ignored.  If
+                      omitted, defaults to False.
 
     Returns 1 value:
 
@@ -49,6 +121,15 @@ def intercomm_broadcast( intercomm, send_value, local_rank, local_root, sending_
               receiving group, this will be send_value and None for everyone
               else.
 
+    NOTE: buffer_flag selects how the value is broadcast and must be the same
+          on every rank.  Ranks that disagree, or that set it without
+          providing a matching array, call different collectives and hang
+          rather than fail.
+
+    NOTE: Pickled values are pickled with protocol 5, when mpi4py supports it,
+          so that large buffers they contain are sent out-of-band rather than
+          copied into the pickled stream.
+
      """
 
     if sending_flag:
@@ -67,4 +148,180 @@ def intercomm_broadcast( intercomm, send_value, local_rank, local_root, sending_
         # note that we use the local rank for the sender.
         value = None
 
+    # broadcast arrays directly from a buffer to avoid pickling them.  the
+    # root always sends in C order so everyone receives in C order regardless
+    # of how their array is laid out.
+    if buffer_flag:
+        if value is None:
+            buffer = np.empty( send_value.shape, dtype=send_value.dtype )
+        else:
+            buffer = np.ascontiguousarray( send_value )
+
+        if not buffer.flags["C_CONTIGUOUS"]:
+            raise ValueError( "Broadcast buffer must be C contiguous." )
+
+        intercomm.Bcast( buffer, root=local_root )
+
+        return None if sending_flag else buffer
+
+    if pkl5 is not None:
+        intercomm = pkl5.Intercomm( intercomm )
+
     return intercomm.bcast( value, root=local_root )
+
+def synchronize_error_counts( intracomm, error_count, application_index, number_applications ):
+    """
+    Exchanges error counts between every application sharing an
+    intracommunicator with a single collective.  This lets all applications
+    gracefully shutdown when any one of them is misconfigured, rather than
+    hanging while waiting on each other.
+
+    Takes 4 arguments:
+
+      intracomm           - Intracommunicator containing every application's
+                            ranks.
+      error_count         - Number of errors encountered by this rank.
+      application_index   - Index of this rank's application.  Each
+                            application must use a distinct index in the
+                            range [0, number_applications).
+      number_applications - Number of applications that may share the
+                            intracommunicator.
+
+    Returns 1 value:
+
+      error_counts - NumPy array, of length number_applications, containing
+                     each application's error count.  Applications not
+                     present in intracomm have a count of 0.
+
+    NOTE: Each application's count is the maximum of its ranks' counts since
+          every rank validates the same configuration.
+
+    """
+
+    # reduce in place so only a single buffer is needed.
+    error_counts = np.zeros( number_applications, dtype="i" )
+    error_counts[application_index] = error_count
+
+    intracomm.Allreduce( MPI.IN_PLACE,
+                         [error_counts, MPI.INT],
+                         op=MPI.MAX )
+
+    return error_counts
+
+def allocate_shared_array( comm, shape, dtype ):
+    """
+    Allocates a NumPy array in memory shared by every rank of an
+    intracommunicator.  The first rank allocates the memory and every other rank
+    maps it so there is a single copy of the array.
+
+    Takes 3 arguments:
+
+      comm  - Intracommunicator whose ranks share memory, such as one
+              created with MPI.COMM_TYPE_SHARED.
+      shape - Shape of the array.
+      dtype - NumPy data type of the array.
+
+    Returns 2 values:
+
+      window - Window exposing the shared memory.  This must be freed after
+               the array is no longer used.
+      array  - Array backed by the shared memory.
+
+    """
+
+    dtype = np.dtype( dtype )
+
+    if comm.Get_rank() == 0:
+        size = int( np.prod( shape ) ) * dtype.itemsize
+    else:
+        size = 0
+
+    window    = MPI.Win.Allocate_shared( size, dtype.itemsize, comm=comm )
+    buffer, _ = window.Shared_query( 0 )
+
+    array = np.ndarray( buffer=buffer, dtype=dtype, shape=shape )
+
+    return window, array
+
+def synchronize_shared_array( window, comm ):
+    """
+    Synchronizes every rank sharing an array allocated with
+    allocate_shared_array() so that updates made before this call are visible
+    to every rank after it.
+
+    Takes 2 arguments:
+
+      window - Window exposing the shared memory.  A passive target epoch
+               must have been started with Lock_all().
+      comm   - Intracommunicator the window was allocated with.
+
+    Returns nothing.
+
+    """
+
+    window.Sync()
+    comm.Barrier()
+    window.Sync()
+
+class PersistentAllgather( object ):
+    """
+    Allgather that is started repeatedly with the same buffers.  MPI-4's
+    persistent collectives are used when available so that argument checking,
+    algorithm selection, and buffer registration happen once rather than each
+    time the collective is started.  Otherwise, this falls back to starting a
+    new non-blocking collective each time.
+
+    Takes 3 arguments:
+
+      comm            - Communicator to perform the collective on.
+      send_message    - Buffer specification of the data sent.
+      receive_message - Buffer specification of the data received.
+
+    """
+
+    def __init__( self, comm, send_message, receive_message ):
+        self.comm            = comm
+        self.send_message    = send_message
+        self.receive_message = receive_message
+
+        try:
+            self.request = comm.Allgather_init( send_message, receive_message )
+        except (AttributeError, NotImplementedError):
+            # either mpi4py or the underlying MPI implementation predates
+            # persistent collectives.
+            self.request = None
+
+    def start( self ):
+        """
+        Starts the collective.  The caller must complete the returned request
+        before starting the collective again.
+
+        Takes no arguments.
+
+        Returns 1 value:
+
+          request - Request to complete the started collective.
+
+        """
+
+        if self.request is None:
+            return self.comm.Iallgather( self.send_message, self.receive_message )
+
+        self.request.Start()
+
+        return self.request
+
+    def free( self ):
+        """
+        Frees the persistent collective, if one was created.  The collective
+        must not be active.
+
+        Takes no arguments.
+
+        Returns nothing.
+
+        """
+
+        if self.request is not None:
+            self.request.Free()
+            self.request = None
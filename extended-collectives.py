@@ -5,7 +5,7 @@ from __future__ import print_function
 from mpi4py import MPI
 import MPIUtility
 
-def demonstrate_broadcast( intercomm, local_rank, world_rank, group_index ):
+def demonstrate_broadcast( intercomm, local_rank, world_rank, group_index, synchronize_flag ):
     """
     Demonstrates broadcast over an intercommunicator.  Conceptually this is a
     single rank in one group broadcasting a value to all of the ranks in the
@@ -44,17 +44,23 @@ def demonstrate_broadcast( intercomm, local_rank, world_rank, group_index ):
     NOTE: The root rank does not need to be 0 so long it is specified
           correctly.
 
-    Takes 4 arguments:
-
-      intercomm   - Intercommunicator shared across all of the ranks
-                    participating in the collective.
-      local_rank  - Rank in the local group attached to the intercommunicator.
-      world_rank  - Rank in the MPI universe.  Note that this is only used
-                    for printing diagnostics rather than participating in
-                    the collective operation.
-      group_index - Index specifying which group the local rank is in.  This
-                    governs which ranks specify MPI.ROOT/MPI.PROC_NULL and
-                    which specify an actual rank for the root rank.
+    Takes 5 arguments:
+
+      intercomm        - Intercommunicator shared across all of the ranks
+                         participating in the collective.
+      local_rank       - Rank in the local group attached to the
+                         intercommunicator.
+      world_rank       - Rank in the MPI universe.  Note that this is only
+                         used for printing diagnostics rather than
+                         participating in the collective operation.
+      group_index      - Index specifying which group the local rank is in.
+                         This governs which ranks specify
+                         MPI.ROOT/MPI.PROC_NULL and which specify an actual
+                         rank for the root rank.
+      synchronize_flag - Flag indicating whether barriers are used between
+                         each step to order the diagnostics printed.  These
+                         are not needed for correctness and only add latency
+                         to the demonstration.
 
     Returns nothing.
 
@@ -80,7 +86,8 @@ def demonstrate_broadcast( intercomm, local_rank, world_rank, group_index ):
 
     # synchronize all of the ranks so our banner is more likely to occur before
     # any output below.
-    intercomm.Barrier()
+    if synchronize_flag:
+        intercomm.Barrier()
 
     value = MPIUtility.intercomm_broadcast( intercomm,
                                             999 + local_root,
@@ -89,12 +96,14 @@ def demonstrate_broadcast( intercomm, local_rank, world_rank, group_index ):
 
     print( "        Rank #{:d}: {}".format( world_rank, value ) )
 
-    intercomm.Barrier()
+    if synchronize_flag:
+        intercomm.Barrier()
 
     if group_index == sending_group and local_rank == local_root:
         print( "\n" )
 
-    intercomm.Barrier()
+    if synchronize_flag:
+        intercomm.Barrier()
 
     # 2. second group broadcasts to first group.
 
@@ -111,7 +120,8 @@ def demonstrate_broadcast( intercomm, local_rank, world_rank, group_index ):
 
     # synchronize all of the ranks so our banner is more likely to occur before
     # any output below.
-    intercomm.Barrier()
+    if synchronize_flag:
+        intercomm.Barrier()
 
     value = MPIUtility.intercomm_broadcast( intercomm,
                                             999 + local_root,
@@ -120,12 +130,14 @@ def demonstrate_broadcast( intercomm, local_rank, world_rank, group_index ):
 
     print( "        Rank #{:d}: {}".format( world_rank, value ) )
 
-    intercomm.Barrier()
+    if synchronize_flag:
+        intercomm.Barrier()
 
     if group_index == sending_group and local_rank == local_root:
         print( "\n" )
 
-    intercomm.Barrier()
+    if synchronize_flag:
+        intercomm.Barrier()
 
     # 3. first group broadcasts to second group, though a non-zero local rank
     #    sends the data.
@@ -145,7 +157,8 @@ def demonstrate_broadcast( intercomm, local_rank, world_rank, group_index ):
 
     # synchronize all of the ranks so our banner is more likely to occur before
     # any output below.
-    intercomm.Barrier()
+    if synchronize_flag:
+        intercomm.Barrier()
 
     value = MPIUtility.intercomm_broadcast( intercomm,
                                             999 + local_root,
@@ -154,12 +167,18 @@ def demonstrate_broadcast( intercomm, local_rank, world_rank, group_index ):
 
     print( "        Rank #{:d}: {}".format( world_rank, value ) )
 
-    intercomm.Barrier()
+    if synchronize_flag:
+        intercomm.Barrier()
 
     if group_index == sending_group and local_rank == local_root:
         print( "\n" )
 
-    intercomm.Barrier()
+    if synchronize_flag:
+        intercomm.Barrier()
+
+# barriers order the diagnostics printed by each rank though are not needed by
+# the collectives demonstrated.  enable them for readable output.
+synchronize_flag = False
 
 # identify who we are in and how big the global intracommunicator is.
 world_comm = MPI.COMM_WORLD
@@ -184,4 +203,4 @@ else:
     inter_comm = our_comm.Create_intercomm( 0, world_comm, 0 )
 
 # show how to broadcast data between the two halves.
-demonstrate_broadcast( inter_comm, our_comm.Get_rank(), world_rank, group_index )
+demonstrate_broadcast( inter_comm, our_comm.Get_rank(), world_rank, group_index, synchronize_flag )
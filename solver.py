@@ -14,13 +14,16 @@ import time
 # number of grid points can be specified to do basic benchmarking of transfer
 # times.
 #
-# possible improvements:
-#
-#   1. allocate the grid on each solver rank and use custom MPI data types
-#      to coalesce multiple collective transfers into a single per timestep.
-#
-#   2. use non-blocking collectives to transfer the most recent field velocities
-#      while computing the next.  requires MPI-3.
+# the most recent field velocities are transferred while the next are computed
+# via non-blocking collectives, which requires MPI-3.  persistent collectives
+# are used instead when MPI-4 is available.
+
+# number of timesteps whose velocities are sent to the tracker in each transfer.
+# batching timesteps reduces the number of collectives performed at the cost of
+# the tracker receiving velocities later, which helps when timesteps are short
+# enough that the cost of each collective dominates.  the tracker is told this
+# at startup.
+iterations_per_transfer = 1
 
 def configure_solver( application_rank, application_size, number_grid_points ):
     """
@@ -71,21 +74,6 @@ application_comm = MPIUtility.partition_by_string( world_comm, sys.argv[0] )
 application_rank = application_comm.Get_rank()
 application_size = application_comm.Get_size()
 
-# configure the solver and confirm our parameters make sense.  we broadcast the
-# failure count so we can gracefully shutdown rather than randomly fail later.
-# note that we broadcast to the world rather than our application group so that
-# the tracker can shutdown as well instead of hanging.
-startup_error_count = configure_solver( application_rank,
-                                        application_size,
-                                        number_grid_points )
-world_comm.bcast( startup_error_count, 0 )
-
-if startup_error_count > 0:
-    if application_rank == 0:
-        print( "Solver had {:d} error{:s} during startup!  Exiting.".format( startup_error_count,
-                                                                             "" if startup_error_count else "s" ) )
-    sys.exit( 1 )
-
 # determine if there are trackers present in the universe by comparing our newly
 # split communicator against the world.
 #
@@ -93,31 +81,54 @@ if startup_error_count > 0:
 #       check against similar/congruent/identical communicators.
 coupled_flag = (MPI.Comm.Compare( application_comm, world_comm ) == MPI.UNEQUAL)
 
+# configure the solver and confirm our parameters make sense.  we exchange
+# failure counts with the tracker, if present, so we can gracefully shutdown
+# rather than randomly fail later.  note that we exchange with the world rather
+# than our application group so that the tracker can shutdown as well instead
+# of hanging.
+#
+# NOTE: the solver's count is first and the tracker's is second.
+startup_error_count = configure_solver( application_rank,
+                                        application_size,
+                                        number_grid_points )
+
+startup_error_counts = MPIUtility.synchronize_error_counts( world_comm,
+                                                            startup_error_count,
+                                                            0,
+                                                            2 )
+
+if startup_error_counts[0] > 0:
+    if application_rank == 0:
+        print( "Solver had {:d} error{:s} during startup!  Exiting.".format( startup_error_counts[0],
+                                                                             "" if startup_error_counts[0] == 1 else "s" ) )
+    sys.exit( 1 )
+elif startup_error_counts[1] > 0:
+    if application_rank == 0:
+        print( "Tracker had {:d} error{:s} during startup.  Exiting.!".format( startup_error_counts[1],
+                                                                               "" if startup_error_counts[1] == 1 else "s" ) )
+    sys.exit( 1 )
+
 # setup our communicator with the tracker if it has been started along side us.
-# confirm that it started up without issue and terminate ourselves if it didn't.
 if coupled_flag:
-    # create an intercommunicator to interact with the tracker via the world
-    # intracommunicator (which contains both solver and tracker).
+    # create an intercommunicator to interact with the tracker.  only one
+    # tracker per node receives velocities, which it shares with the other
+    # trackers on its node, so we create an intracommunicator containing the
+    # solvers and those trackers to create it with.  the trackers do the same.
     #
     # NOTE: the leader in the remote group is one past this application's last
     #       rank.
     #
-    intercomm = application_comm.Create_intercomm( 0, world_comm, application_size )
-
-    # confirm that the tracker's startup was successful.
-    startup_error_count = MPIUtility.intercomm_broadcast( intercomm,
-                                                          # NOTE: this isn't used since the solver isn't sending anything.
-                                                          0,
-                                                            application_rank,
-                                                          # remote root.
-                                                          0,
-                                                          False )
-
-    if startup_error_count > 0:
-        if application_rank == 0:
-            print( "Tracker had {:d} error{:s} during startup.  Exiting.!".format( startup_error_count,
-                                                                                   "" if startup_error_count == 1 else "s" ) )
-        sys.exit( 1 )
+    coupling_comm = world_comm.Split( 0, key=world_rank )
+    intercomm     = MPIUtility.make_intercomm( application_comm, 0, coupling_comm, application_size )
+
+    # let the tracker know how many timesteps are sent in each transfer.  the
+    # count is broadcast from a NumPy buffer so it isn't pickled.
+    MPIUtility.intercomm_broadcast( intercomm,
+                                    np.array( [iterations_per_transfer], dtype="i" ),
+                                    application_rank,
+                                    0,
+                                    True,
+                                    True )
 
 # let the caller know how we were started.
 if application_rank == 0:
@@ -130,22 +141,58 @@ if application_rank == 0:
     else:
         print( "" )
 
-# allocate space for our field's velocities.  we create three variables to
-# better reflect the storage on individual solver ranks.
+# allocate space for our field's velocities.  the three components of each
+# grid point are stored next to each other, and the grid points are stored in
+# a single, contiguous block so that each solver's grid fragment can be sent
+# with one collective instead of three.  a batch of blocks, one per timestep
+# sent in a single transfer, is kept and two batches are allocated so that the
+# previous batch can be transferred while the current is computed.
 grid_per_rank = number_grid_points // application_size
 
-velocity_x = np.ones( grid_per_rank, dtype="d" ) * application_rank
-velocity_y = np.ones( grid_per_rank, dtype="d" ) * application_rank
-velocity_z = np.ones( grid_per_rank, dtype="d" ) * application_rank
-empty_data = np.zeros( 0, dtype="d" )
+velocities = np.ones( (2, iterations_per_transfer, grid_per_rank, 3), dtype="d" ) * application_rank
+
+# setup the transfer of each batch once since the same buffers are sent every
+# time.  each grid point's velocity is sent as a single item.
+#
+# NOTE: we don't receive anything and describe that with an empty buffer rather
+#       than allocating one.  MPI.IN_PLACE is not valid for
+#       intercommunicators.
+if coupled_flag:
+    point_type = MPI.DOUBLE.Create_contiguous( 3 ).Commit()
+
+    transfers = [MPIUtility.PersistentAllgather( intercomm,
+                                                 [velocities[batch_index],
+                                                  iterations_per_transfer * grid_per_rank,
+                                                  point_type],
+                                                 [None, MPI.DOUBLE] )
+                 for batch_index in range( 2 )]
+
+transfer_request = MPI.REQUEST_NULL
+
+# look up the functions called every timestep once.
+sleep = time.sleep
+wtime = MPI.Wtime
 
 for iteration_count in range( number_iterations ):
+    # alternate between the batches so we never update velocities that are
+    # being transferred.  we create three views into this timestep's block,
+    # one per component, to better reflect the storage on individual solver
+    # ranks.
+    batch_index = (iteration_count // iterations_per_transfer) % 2
+    step_index  = iteration_count % iterations_per_transfer
+
+    velocity = velocities[batch_index, step_index]
+    velocity_x, velocity_y, velocity_z = velocity.T
+
     print( "Solving for velocities [solver {:d}].".format( application_rank ) )
 
-    time.sleep( delay_length )
+    sleep( delay_length )
 
-    if coupled_flag:
-        # send the field's solution for this timestep to the tracker.  this
+    # send the batch once it is full or we've computed the last timestep.  the
+    # tracker ignores the unused timesteps of a partial batch.
+    if coupled_flag and ((step_index == (iterations_per_transfer - 1)) or
+                         (iteration_count == (number_iterations - 1))):
+        # send the field's solution for these timesteps to the tracker.  this
         # "gather" sends each solver's slice of the grid to each tracker so
         # they all have a full solution.  this allows dynamic partitioning
         # of the grid to efficiently process the particles.
@@ -154,25 +201,38 @@ for iteration_count in range( number_iterations ):
         #       performed with Allgatherv() though would require back
         #       communication from the trackers to identify portions of the
         #       grid to pull.
-
-        # XXX: a real implementation should have a custom MPI data type that
-        #      ensures each solver's grid fragment is sent as a single block of
-        #      data rather than as three.
         #
-        # XXX: transfer of previous velocities could be done while the current
-        #      are being computed via IAllgather().
-        timer_start = time.clock()
-        intercomm.Allgather( [velocity_x, MPI.DOUBLE],
-                             [empty_data, MPI.DOUBLE] )
-
-        intercomm.Allgather( [velocity_y, MPI.DOUBLE],
-                             [empty_data, MPI.DOUBLE] )
+        # NOTE: each grid point's velocity, for each timestep in the batch, is
+        #       sent as a single block of data.  each tracker receives the
+        #       blocks in solver rank order.
+        #
+        # NOTE: the previous batch's transfer must complete before we start
+        #       this one.  the time reported is how long we waited on it rather
+        #       than the time to transfer a solution, the remainder of which
+        #       was hidden behind this batch's computation.
+        #
+        # NOTE: we intentionally don't synchronize with a barrier before
+        #       timing.  doing so would hide any imbalance between the ranks
+        #       and then attribute it to the collective that follows, inflating
+        #       the time reported.
+        timer_start = wtime()
+        transfer_request.Wait()
+        transfer_time = wtime() - timer_start
 
-        intercomm.Allgather( [velocity_z, MPI.DOUBLE],
-                             [empty_data, MPI.DOUBLE] )
-        transfer_time = time.clock() - timer_start
+        transfer_request = transfers[batch_index].start()
 
         if application_rank == 0:
-            print( "   {:.2f}s to transfer solution.".format( transfer_time ) )
+            print( "   {:.2f}s waiting on the previous solution's transfer.".format( transfer_time ) )
+
+# wait for the last timestep's solution to reach the tracker.
+transfer_request.Wait()
+
+# release our connection to the tracker.  MPI itself is finalized when we
+# exit.
+if coupled_flag:
+    for transfer in transfers:
+        transfer.free()
+
+    point_type.Free()
 
-MPI.Finalize()
+    intercomm.Disconnect()
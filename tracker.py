@@ -14,7 +14,7 @@ import time
 # configuration.  the number of grid points and particles can be specified to
 # do basic benchmarking of transfer times and memory requirements.
 #
-# see the solver for a list of potential improvements.
+# see the README for a list of potential improvements.
 
 def configure_tracker( application_rank, application_size, number_particles ):
     """
@@ -62,8 +62,6 @@ world_comm = MPI.COMM_WORLD
 world_rank = world_comm.Get_rank()
 world_size = world_comm.Get_size()
 
-startup_error_count = 0
-
 # get the characteristics of the trackers.
 application_comm = MPIUtility.partition_by_string( world_comm, sys.argv[0] )
 application_rank = application_comm.Get_rank()
@@ -84,65 +82,153 @@ if not coupled_flag:
         print( "Looks like we're all alone in the universe.  Exiting." )
     sys.exit( 1 )
 
-# check to see if the solver started up and exit if not.
-startup_error_count = world_comm.bcast( 0, 0 )
-
-if startup_error_count > 0:
-    sys.exit( 1 )
-
-# configure the tracker and confirm our parameters make sense.  we broadcast
-# the failure count so the solver can shutdown if we're not able to run.
+# configure the tracker and confirm our parameters make sense.  we exchange
+# failure counts with the solver so that both shutdown if either is not able to
+# run.
+#
+# NOTE: the solver's count is first and the tracker's is second.
 startup_error_count = configure_tracker( application_rank,
                                          application_size,
                                          number_particles )
 
-# create an intercommunicator to interact with the tracker via the world
-# intracommunicator (which contains both solver and tracker).
-#
-# NOTE: the leader in the remote group is the first rank in the universe.
-#
-intercomm = application_comm.Create_intercomm( 0, world_comm, 0 )
+startup_error_counts = MPIUtility.synchronize_error_counts( world_comm,
+                                                            startup_error_count,
+                                                            1,
+                                                            2 )
 
-# send our startup status to the solver.
-MPIUtility.intercomm_broadcast( intercomm,
-                                startup_error_count,
-                                application_rank,
-                                0,
-                                True )
-
-if startup_error_count > 0:
+if startup_error_counts.any():
     sys.exit( 1 )
 
-# each tracker has space for the entire grid.  velocities for each grid point
-# are received by each process so the particles can be efficiently load
+# trackers on the same node share a single copy of the grid.  one tracker per
+# node, the node's leader, receives velocities from the solver into memory
+# shared with the node's other trackers.  this reduces the memory and bandwidth
+# needed by the number of trackers per node.
+node_comm   = application_comm.Split_type( MPI.COMM_TYPE_SHARED, key=application_rank )
+leader_flag = (node_comm.Get_rank() == 0)
+leader_comm = application_comm.Split( 0 if leader_flag else MPI.UNDEFINED, key=application_rank )
+
+# create an intracommunicator containing the solvers and the node leaders so
+# that only the leaders participate in transfers.  the solver does the same.
+coupling_comm = world_comm.Split( 0 if leader_flag else MPI.UNDEFINED, key=world_rank )
+
+iterations_per_transfer_buffer = np.zeros( 1, dtype="i" )
+
+if leader_flag:
+    # create an intercommunicator to interact with the solver.
+    #
+    # NOTE: the leader in the remote group is the first rank in the universe.
+    #       the first tracker leads both its node and the local group.
+    #
+    intercomm = MPIUtility.make_intercomm( leader_comm, 0, coupling_comm, 0 )
+
+    # find out how many timesteps the solver sends in each transfer.  the
+    # count is broadcast into a NumPy buffer so it isn't pickled.
+    iterations_per_transfer_buffer = MPIUtility.intercomm_broadcast( intercomm,
+                                                                     # NOTE: this only describes the buffer received.
+                                                                     iterations_per_transfer_buffer,
+                                                                     leader_comm.Get_rank(),
+                                                                     # remote root.
+                                                                     0,
+                                                                     False,
+                                                                     True )
+
+# share the batch size with the rest of our node.
+node_comm.Bcast( [iterations_per_transfer_buffer, MPI.INT], root=0 )
+iterations_per_transfer = int( iterations_per_transfer_buffer[0] )
+
+# each node has space for the entire grid.  velocities for each grid point
+# are received by each node so the particles can be efficiently load
 # balanced.  this may be distributing particles amongst the trackers or
 # distributing a subset of the grid to individual trackers for truly
 # large grids.
-velocity_x = np.empty( number_grid_points, dtype="d" )
-velocity_y = np.empty( number_grid_points, dtype="d" )
-velocity_z = np.empty( number_grid_points, dtype="d" )
-empty_data = np.zeros( 0, dtype="d" )
+#
+# NOTE: each solver sends its grid fragment, for each timestep in a batch, as a
+#       single block of grid points with all three velocity components.  the
+#       components of each grid point are stored next to each other so that
+#       tracking a particle touches a single location per grid point.
+#
+# NOTE: two batches are allocated so that the next batch's velocities can be
+#       received while particles are tracked with the current.
+window, velocities = MPIUtility.allocate_shared_array( node_comm,
+                                                       (2, iterations_per_transfer, number_grid_points, 3),
+                                                       "d" )
+window.Lock_all( MPI.MODE_NOCHECK )
+
+number_transfers = (number_iterations + iterations_per_transfer - 1) // iterations_per_transfer
+
+if leader_flag:
+    number_solvers = intercomm.Get_remote_size()
+    grid_per_rank  = number_grid_points // number_solvers
+
+    # each solver's block is runs of grid_per_rank points, one per timestep,
+    # that are number_grid_points apart.  resizing the type's extent to a
+    # single run places consecutive solvers' blocks next to each other.
+    point_type    = MPI.DOUBLE.Create_contiguous( 3 )
+    fragment_type = point_type.Create_vector( iterations_per_transfer,
+                                              grid_per_rank,
+                                              number_grid_points )
+    block_type    = fragment_type.Create_resized( 0, grid_per_rank * point_type.Get_extent()[1] ).Commit()
+    fragment_type.Free()
+    point_type.Free()
+
+    # setup the receive into each batch once since the same buffers are
+    # received into every time.
+    #
+    # NOTE: we don't send anything and describe that with an empty buffer
+    #       rather than allocating one.
+    receives = [MPIUtility.PersistentAllgather( intercomm,
+                                                [None, MPI.DOUBLE],
+                                                [velocities[batch_index], 1, block_type] )
+                for batch_index in range( 2 )]
+
+    # send nothing, receive things.  receives are posted into both batches
+    # before we enter the loop, and each batch's receive is reposted as soon as
+    # our node is done tracking with it, so the solver's velocities can be
+    # placed directly into our grid as soon as they're sent rather than waiting
+    # for us to ask for them.
+    #
+    # NOTE: receives are started in the same order as the solver's transfers.
+    receive_requests = [MPI.REQUEST_NULL, MPI.REQUEST_NULL]
+    for batch_index in range( min( 2, number_transfers ) ):
+        receive_requests[batch_index] = receives[batch_index].start()
+
+# look up the functions called every timestep once.
+sleep       = time.sleep
+synchronize = MPIUtility.synchronize_shared_array
 
 for iteration_count in range( number_iterations ):
+    batch_number = iteration_count // iterations_per_transfer
+    batch_index  = batch_number % 2
+    step_index   = iteration_count % iterations_per_transfer
 
-    # send nothing, receive things.
-    #
-    # XXX: a real implementation should have a custom MPI data type that
-    #      ensures each solver's grid fragment is sent as a single block of
-    #      data rather than as three.
-    #
-    # XXX: transfer of previous velocities could be done while the current
-    #      are being computed via IAllgather().
-    intercomm.Allgather( [empty_data, MPI.DOUBLE],
-                         [velocity_x, MPI.DOUBLE] )
+    if step_index == 0:
+        # wait for everyone on our node to be done with the previous batch and
+        # then start receiving the batch after this one into it.
+        if (batch_number > 0) and ((batch_number + 1) < number_transfers):
+            synchronize( window, node_comm )
+
+            if leader_flag:
+                receive_requests[1 - batch_index] = receives[1 - batch_index].start()
+
+        # wait for this batch's velocities and make them visible to our node.
+        if leader_flag:
+            receive_requests[batch_index].Wait()
 
-    intercomm.Allgather( [empty_data, MPI.DOUBLE],
-                         [velocity_y, MPI.DOUBLE] )
+        synchronize( window, node_comm )
 
-    intercomm.Allgather( [empty_data, MPI.DOUBLE],
-                         [velocity_z, MPI.DOUBLE] )
+    velocity_x, velocity_y, velocity_z = velocities[batch_index, step_index].T
 
     print( "Tracking particles [tracker {:d}].".format( world_rank ) )
-    time.sleep( delay_length )
+    sleep( delay_length )
+
+# release our connection to the solver.  MPI itself is finalized when we exit.
+if leader_flag:
+    for receive in receives:
+        receive.free()
+
+    block_type.Free()
+
+    intercomm.Disconnect()
 
-MPI.Finalize()
+window.Unlock_all()
+window.Free()